@@ -1,20 +1,28 @@
 # app.py
+import atexit
+import mimetypes
 import os
 import subprocess
 import uuid
 import json
 import shutil
+import socket
+import tempfile
+import threading
 import time
+from contextlib import contextmanager
 from datetime import datetime
-from flask import Flask, request, render_template, jsonify, send_from_directory, abort
+from flask import Flask, request, render_template, jsonify, send_from_directory, send_file, abort, redirect, after_this_request
 from flask_cors import CORS
 from werkzeug.utils import secure_filename
 from pathlib import Path
 from dotenv import load_dotenv
-from PIL import Image
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.triggers.cron import CronTrigger
 import pytz
+from concurrent.futures.process import BrokenProcessPool
+from image_ops import ImageWorkerPool, is_readable_image, optimize_image_for_gemini
+from storage import LocalShardedStorage, ReadThroughCache, S3Storage
 
 # Set UTF-8 encoding for the entire application
 import sys
@@ -32,83 +40,105 @@ if sys.platform == 'win32':
 
 load_dotenv()
 
-UPLOAD_FOLDER = Path("uploads")
-OUTPUT_FOLDER = Path("outputs")
+WORK_FOLDER = Path("work")  # per-request scratch space, published to storage when done
 SAMPLES_FOLDER = Path("samples")  # optional: place pre-made sample images here
 ALLOWED_EXT = {"png","jpg","jpeg","webp"}
 
 API_KEY = os.environ.get("GEMINI_API_KEY")  # put your API key in .env or env var
 MODEL_NAME = os.environ.get("GEMINI_MODEL","gemini-2.5-flash-image")
 CLEANUP_AGE_HOURS = int(os.environ.get("CLEANUP_AGE_HOURS", "24"))  # Default 24 hours
+GENERATION_DEADLINE_SECONDS = float(os.environ.get("GENERATION_DEADLINE_SECONDS", "600"))  # Whole-request budget
+MAX_CONCURRENT_GENERATIONS = int(os.environ.get("MAX_CONCURRENT_GENERATIONS", "4"))
+CANCEL_POLL_SECONDS = 0.5  # How often running work checks for deadline / client disconnect
+# Share of the request budget planned for each stage. A stage's reserve is its share of the budget, capped at
+# GENERATION_STEP_RESERVE_MAX_SECONDS (so the shares only matter for short budgets). A stage may only start if
+# the time left covers its reserve plus the reserves of later stages; once running it may use everything except
+# those later reserves.
+STAGE_BUDGET_SHARES = {"normalize": 0.1, "step1": 0.45, "step2": 0.45}
+GENERATION_STEP_RESERVE_MAX_SECONDS = float(os.environ.get("GENERATION_STEP_RESERVE_MAX_SECONDS", "10"))
+GENERATE_TIMEOUT_SECONDS = 300  # Hard limit for a single generate.py run
+# Assumed duration of a step before any has been observed; counts as one sample in the running average
+GENERATION_STEP_SECONDS_PRIOR = float(os.environ.get("GENERATION_STEP_SECONDS_PRIOR", "30"))
+IMAGE_POOL_WORKERS = int(os.environ.get("IMAGE_POOL_WORKERS", str(min(os.cpu_count() or 1, 4))))  # 0 = always inline
+IMAGE_POOL_MAX_PENDING = int(os.environ.get("IMAGE_POOL_MAX_PENDING", "16"))  # queued + running image tasks
+IMAGE_INLINE_MAX_BYTES = int(os.environ.get("IMAGE_INLINE_MAX_BYTES", str(512 * 1024)))  # smaller files skip the pool
+# Uploads and outputs storage: "local" (hash-sharded directory, may be a shared volume) or "s3"
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "local").lower()
+STORAGE_ROOT = Path(os.environ.get("STORAGE_ROOT", "storage"))
+STORAGE_CACHE_FOLDER = Path(os.environ.get("STORAGE_CACHE_FOLDER", "cache"))
+STORAGE_CACHE_MB = int(os.environ.get("STORAGE_CACHE_MB", "256"))
+STORAGE_REDIRECT = os.environ.get("STORAGE_REDIRECT", "false").lower() in ("1", "true", "yes")  # presigned redirects, needs bucket CORS
+STORAGE_URL_EXPIRES = int(os.environ.get("STORAGE_URL_EXPIRES", "3600"))
 
 app = Flask(__name__)
 CORS(app)  # Enable CORS for all routes
 app.config['MAX_CONTENT_LENGTH'] = 20 * 1024 * 1024  # 20 MB limit per upload
 
-UPLOAD_FOLDER.mkdir(exist_ok=True)
-OUTPUT_FOLDER.mkdir(exist_ok=True)
+WORK_FOLDER.mkdir(exist_ok=True)
 SAMPLES_FOLDER.mkdir(exist_ok=True)
 
 
+def create_storage():
+    """Build the uploads/outputs storage backend selected by STORAGE_BACKEND"""
+    if STORAGE_BACKEND == "s3":
+        return S3Storage(
+            bucket=os.environ["S3_BUCKET"],
+            cache=ReadThroughCache(STORAGE_CACHE_FOLDER, STORAGE_CACHE_MB * 1024 * 1024),
+            endpoint_url=os.environ.get("S3_ENDPOINT_URL") or None,
+            region=os.environ.get("S3_REGION") or None,
+            access_key=os.environ.get("S3_ACCESS_KEY") or None,
+            secret_key=os.environ.get("S3_SECRET_KEY") or None,
+            public_endpoint_url=os.environ.get("S3_PUBLIC_ENDPOINT_URL") or None,
+        )
+    if STORAGE_BACKEND == "local":
+        return LocalShardedStorage(STORAGE_ROOT)
+    raise RuntimeError(f"Unknown STORAGE_BACKEND '{STORAGE_BACKEND}' (expected 'local' or 's3')")
+
+
+_storage = None
+_storage_lock = threading.Lock()
+
+
+def get_storage():
+    """Storage backend, created on first use so importing app.py stays cheap"""
+    global _storage
+    with _storage_lock:
+        if _storage is None:
+            _storage = create_storage()
+        return _storage
+
+
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXT
 
 
 def cleanup_old_files():
-    """Delete files and folders older than CLEANUP_AGE_HOURS in uploads and outputs directories"""
+    """Delete uploads, outputs and scratch folders older than CLEANUP_AGE_HOURS"""
     try:
         current_time = time.time()
         age_threshold = CLEANUP_AGE_HOURS * 3600  # Convert hours to seconds
-        deleted_files = 0
-        deleted_folders = 0
-        freed_space = 0
 
         print(f"[CLEANUP] Starting cleanup at {datetime.now().strftime('%Y-%m-%d %H:%M:%S')} (VN Time)", flush=True)
         print(f"[CLEANUP] Deleting files/folders older than {CLEANUP_AGE_HOURS} hours", flush=True)
 
-        # Clean uploads folder
-        if UPLOAD_FOLDER.exists():
-            for item in UPLOAD_FOLDER.iterdir():
-                try:
-                    item_age = current_time - item.stat().st_mtime
-                    if item_age > age_threshold:
-                        if item.is_file():
-                            size = item.stat().st_size
-                            item.unlink()
-                            deleted_files += 1
-                            freed_space += size
-                            print(f"[CLEANUP] Deleted file: {item.name} ({size / 1024:.2f} KB)", flush=True)
-                        elif item.is_dir():
-                            size = sum(f.stat().st_size for f in item.rglob('*') if f.is_file())
-                            shutil.rmtree(item)
-                            deleted_folders += 1
-                            freed_space += size
-                            print(f"[CLEANUP] Deleted folder: {item.name} ({size / 1024:.2f} KB)", flush=True)
-                except Exception as e:
-                    print(f"[CLEANUP] Error deleting {item}: {e}", flush=True)
+        # Clean uploads and outputs in the storage backend
+        deleted_items, freed_space = get_storage().cleanup(age_threshold, log=lambda msg: print(msg, flush=True))
 
-        # Clean outputs folder
-        if OUTPUT_FOLDER.exists():
-            for item in OUTPUT_FOLDER.iterdir():
+        # Clean scratch folders left behind by interrupted requests
+        if WORK_FOLDER.exists():
+            for item in WORK_FOLDER.iterdir():
                 try:
-                    item_age = current_time - item.stat().st_mtime
-                    if item_age > age_threshold:
+                    if current_time - item.stat().st_mtime > age_threshold:
                         if item.is_dir():
-                            size = sum(f.stat().st_size for f in item.rglob('*') if f.is_file())
                             shutil.rmtree(item)
-                            deleted_folders += 1
-                            freed_space += size
-                            print(f"[CLEANUP] Deleted output folder: {item.name} ({size / 1024:.2f} KB)", flush=True)
-                        elif item.is_file():
-                            size = item.stat().st_size
+                        else:
                             item.unlink()
-                            deleted_files += 1
-                            freed_space += size
-                            print(f"[CLEANUP] Deleted output file: {item.name} ({size / 1024:.2f} KB)", flush=True)
+                        deleted_items += 1
+                        print(f"[CLEANUP] Deleted scratch item: {item.name}", flush=True)
                 except Exception as e:
                     print(f"[CLEANUP] Error deleting {item}: {e}", flush=True)
 
-        print(f"[CLEANUP] Completed: {deleted_files} files, {deleted_folders} folders deleted", flush=True)
+        print(f"[CLEANUP] Completed: {deleted_items} items deleted", flush=True)
         print(f"[CLEANUP] Total space freed: {freed_space / 1024 / 1024:.2f} MB", flush=True)
 
     except Exception as e:
@@ -125,130 +155,351 @@ def load_banknote_styles():
         return {"banknotes": []}
 
 
-def run_generate_command(prompt, image_paths, output_dir):
-    """Helper to run generate.py with subprocess"""
-    cmd = [
-        'python', 'generate.py',
-        '--images', *image_paths,
-        '--prompt', prompt,
-        '--outdir', output_dir,
-        '--api-key', API_KEY,
-        '--model', MODEL_NAME
-    ]
+class GenerationCancelled(Exception):
+    """Raised when a generation is abandoned because its deadline passed or its client went away"""
+
+    def __init__(self, reason, stage):
+        super().__init__(f"{reason} during {stage}")
+        self.reason = reason  # 'deadline' or 'client_disconnected'
+        self.stage = stage
 
-    try:
-        # Set environment to handle UTF-8 encoding
-        env = os.environ.copy()
-        env['PYTHONIOENCODING'] = 'utf-8'
-        completed = subprocess.run(cmd, capture_output=True, text=True, timeout=300, env=env)
-        return completed
-    except subprocess.TimeoutExpired:
-        class ProcessResult:
-            def __init__(self):
-                self.returncode = 1
-                self.stdout = ""
-                self.stderr = "Generation timed out"
-        return ProcessResult()
 
+class GenerationContext:
+    """
+    Deadline budget and liveness of the client for a single generation request.
 
-def fix_image_orientation(image_path):
+    The budget comes from GENERATION_DEADLINE_SECONDS and may be shortened (never
+    extended) by the caller with an X-Request-Timeout header, e.g. when a proxy
+    in front of us gives up earlier. A running step may use all remaining time
+    except the reserve kept back for the steps after it.
     """
-    Fix image orientation based on EXIF data to prevent iPhone rotation issues.
-    iPhone photos contain EXIF orientation metadata that browsers don't interpret,
-    causing images to appear rotated when uploaded.
 
-    Args:
-        image_path: Path to image file to fix orientation for
+    def __init__(self, environ, headers):
+        budget = GENERATION_DEADLINE_SECONDS
+        try:
+            requested = float(headers.get('X-Request-Timeout', ''))
+            if requested > 0:
+                budget = min(budget, requested)
+        except ValueError:
+            pass
+
+        self.budget = budget
+        self.started = time.monotonic()
+        self.deadline = self.started + budget
+        # Raw client socket: set by the Werkzeug dev server and by gunicorn
+        self._socket = environ.get('werkzeug.socket') or environ.get('gunicorn.socket')
+
+    def remaining(self):
+        return max(self.deadline - time.monotonic(), 0.0)
+
+    def reserve(self, stage):
+        """Time kept back for `stage`: its share of the budget, capped at GENERATION_STEP_RESERVE_MAX_SECONDS"""
+        return min(STAGE_BUDGET_SHARES[stage] * self.budget, GENERATION_STEP_RESERVE_MAX_SECONDS)
+
+    def step_budget(self, step, later_steps=()):
+        """
+        Seconds `step` may run: the remaining time minus the reserves of `later_steps`.
+        Raises GenerationCancelled if what is left does not cover the step's own reserve
+        (give or take one poll interval, as the shares add up to the whole budget).
+        """
+        available = self.remaining() - sum(self.reserve(s) for s in later_steps)
+        if available <= 0 or available < self.reserve(step) - CANCEL_POLL_SECONDS:
+            raise GenerationCancelled('deadline', step)
+        return available
+
+    def client_disconnected(self):
+        if self._socket is None or not hasattr(socket, 'MSG_DONTWAIT'):
+            return False
+        try:
+            # The request body has already been read, so an orderly EOF means the client hung up
+            return self._socket.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT) == b''
+        except (BlockingIOError, InterruptedError):
+            return False
+        except OSError:
+            return True
 
-    Returns:
-        True if orientation was fixed or no fix needed, False if error occurred
+    def check(self, stage):
+        """Raise GenerationCancelled if nobody will read the result of `stage`"""
+        if self.client_disconnected():
+            raise GenerationCancelled('client_disconnected', stage)
+        if self.remaining() <= 0:
+            raise GenerationCancelled('deadline', stage)
+
+
+class GenerationStats:
+    """Thread-safe counters for cancelled work and the model time it saved"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.queued = 0
+        self.running = 0
+        self.cancelled = {'deadline': 0, 'client_disconnected': 0}
+        self.dropped_from_queue = 0
+        self.killed_in_flight = 0
+        self.killed_after_seconds = 0.0  # model time already spent on steps when they were killed
+        self.steps_skipped = 0
+        self.model_seconds_saved = 0.0
+        # Running average of step durations, used to estimate saved time. It starts from
+        # GENERATION_STEP_SECONDS_PRIOR so cancellations after a cold start are not counted as 0 s.
+        self._step_seconds = {
+            'step1': [GENERATION_STEP_SECONDS_PRIOR, 1],
+            'step2': [GENERATION_STEP_SECONDS_PRIOR, 1],
+        }
+
+    def expected_step_seconds(self, step):
+        total, count = self._step_seconds[step]
+        return total / count
+
+    def record_step(self, step, seconds):
+        with self.lock:
+            self._step_seconds[step][0] += seconds
+            self._step_seconds[step][1] += 1
+
+    def record_cancel(self, exc, killed_step=None, killed_after=0.0, skipped_steps=(), from_queue=False):
+        with self.lock:
+            self.cancelled[exc.reason] += 1
+            if from_queue:
+                self.dropped_from_queue += 1
+            if killed_step:
+                self.killed_in_flight += 1
+                self.killed_after_seconds += killed_after
+                self.model_seconds_saved += max(self.expected_step_seconds(killed_step) - killed_after, 0.0)
+            for step in skipped_steps:
+                self.steps_skipped += 1
+                self.model_seconds_saved += self.expected_step_seconds(step)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'queued': self.queued,
+                'running': self.running,
+                'max_concurrent': MAX_CONCURRENT_GENERATIONS,
+                'cancelled': dict(self.cancelled),
+                'dropped_from_queue': self.dropped_from_queue,
+                'killed_in_flight': self.killed_in_flight,
+                'killed_after_seconds': round(self.killed_after_seconds, 2),
+                'steps_skipped': self.steps_skipped,
+                'model_seconds_saved': round(self.model_seconds_saved, 2),
+                'avg_step_seconds': {
+                    step: round(self.expected_step_seconds(step), 2) for step in self._step_seconds
+                },
+            }
+
+
+generation_stats = GenerationStats()
+generation_slots = threading.BoundedSemaphore(MAX_CONCURRENT_GENERATIONS)
+
+
+@contextmanager
+def generation_slot(ctx, steps):
+    """
+    Wait for a free model slot, giving up as soon as the request is dead.
+    `steps` are the model steps this request would run, counted as saved if dropped.
     """
+    with generation_stats.lock:
+        generation_stats.queued += 1
+    try:
+        while not generation_slots.acquire(timeout=CANCEL_POLL_SECONDS):
+            try:
+                ctx.check('queue')
+            except GenerationCancelled as exc:
+                generation_stats.record_cancel(exc, skipped_steps=steps, from_queue=True)
+                print(f"[CANCEL] Dropped queued generation: {exc}", flush=True)
+                raise
+    finally:
+        with generation_stats.lock:
+            generation_stats.queued -= 1
+
+    with generation_stats.lock:
+        generation_stats.running += 1
     try:
-        with Image.open(image_path) as img:
-            exif = img._getexif()
-            if not exif:
-                return True
-
-            orientation_key = 0x0112
-            if orientation_key not in exif:
-                return True
-
-            orientation = exif[orientation_key]
-            orientation_fixed = False
-
-            # Apply rotation based on EXIF orientation
-            if orientation == 1:
-                pass  # Normal (no rotation)
-            elif orientation == 2:
-                img = img.transpose(Image.Transpose.FLIP_LEFT_RIGHT)
-                orientation_fixed = True
-            elif orientation == 3:
-                img = img.transpose(Image.Transpose.ROTATE_180)
-                orientation_fixed = True
-            elif orientation == 4:
-                img = img.transpose(Image.Transpose.FLIP_TOP_BOTTOM)
-                orientation_fixed = True
-            elif orientation == 5:
-                img = img.transpose(Image.Transpose.ROTATE_270).transpose(Image.Transpose.FLIP_LEFT_RIGHT)
-                orientation_fixed = True
-            elif orientation == 6:
-                img = img.transpose(Image.Transpose.ROTATE_270)
-                orientation_fixed = True
-            elif orientation == 7:
-                img = img.transpose(Image.Transpose.ROTATE_270).transpose(Image.Transpose.FLIP_TOP_BOTTOM)
-                orientation_fixed = True
-            elif orientation == 8:
-                img = img.transpose(Image.Transpose.ROTATE_90)
-                orientation_fixed = True
-            else:
-                return True  # Unknown orientation, skip processing
-
-            # Save the image if we made changes
-            if orientation_fixed:
-                img.save(image_path, quality=95)
+        yield
+    finally:
+        with generation_stats.lock:
+            generation_stats.running -= 1
+        generation_slots.release()
+
+
+_image_pool = None
+_image_pool_lock = threading.Lock()
 
-            return True
 
-    except Exception:
-        return False
+def get_image_pool():
+    """Image process pool, created on first use so spawned workers importing app.py don't start their own"""
+    global _image_pool
+    with _image_pool_lock:
+        if _image_pool is None:
+            _image_pool = ImageWorkerPool(IMAGE_POOL_WORKERS, IMAGE_POOL_MAX_PENDING, IMAGE_INLINE_MAX_BYTES)
+            atexit.register(_image_pool.shutdown)
+        return _image_pool
 
 
-def optimize_image_for_gemini(image_path, max_dimension=1024):
+def cancelled_response(exc):
+    """JSON response for a generation abandoned by GenerationCancelled"""
+    if exc.reason == 'deadline':
+        return jsonify({"error": f"Generation deadline exceeded during {exc.stage}"}), 504
+    # Client closed the connection; nobody reads this, 499 keeps access logs honest
+    return jsonify({"error": f"Client disconnected during {exc.stage}"}), 499
+
+
+def normalize_upload(image_path, ctx):
     """
-    Optimize image for Gemini Flash processing by downscaling if too large.
-    Only resizes if width or height exceeds max_dimension (default 1024px).
-    Preserves aspect ratio using thumbnail() to avoid distortion.
+    Run optimize_image_for_gemini in the image pool and return its result.
+
+    When a worker dies every task in that executor fails, so a task lost to
+    BrokenProcessPool is retried once in a worker of its own; only if this image
+    kills that worker too does BrokenProcessPool propagate. Falls back to inline
+    processing if the task could not be handed to the pool at all.
 
-    Based on Gemini Flash documentation:
-    - Images ≤1024×1024: optimal quality and processing speed
-    - Images >1024×1024: automatically tiled (slower, more tokens)
+    Waiting is limited to the time left after reserving step 1 and step 2.
+    """
+    normalize_deadline = time.monotonic() + ctx.step_budget('normalize', ('step1', 'step2'))
 
-    Args:
-        image_path: Path to image file to optimize
-        max_dimension: Maximum width/height in pixels (default 1024)
+    def cancel_check():
+        ctx.check('normalize')
+        if time.monotonic() >= normalize_deadline:
+            raise GenerationCancelled('deadline', 'normalize')
 
-    Returns:
-        True if successful, False if error occurred
+    for attempt in range(2):
+        try:
+            return get_image_pool().run(
+                optimize_image_for_gemini,
+                str(image_path),
+                cancel_check=cancel_check,
+                poll_seconds=CANCEL_POLL_SECONDS,
+                isolated=bool(attempt)
+            )
+        except GenerationCancelled:
+            raise
+        except BrokenProcessPool:
+            if attempt:
+                raise
+            print(f"[IMAGE POOL] Worker died while processing {image_path.name}, retrying in an isolated worker", flush=True)
+        except Exception as e:
+            print(f"[IMAGE POOL] Pool task failed ({e}), processing inline", flush=True)
+            return optimize_image_for_gemini(str(image_path))
+
+
+def run_generate_command(prompt, image_paths, output_dir, ctx=None, step=None, remaining_steps=()):
     """
-    try:
-        # Step 1: Fix EXIF orientation to prevent iPhone rotation issues
-        fix_image_orientation(image_path)
+    Helper to run generate.py with subprocess.
 
-        # Step 2: Optimize image size
-        with Image.open(image_path) as img:
-            # Convert RGBA to RGB if needed
-            if img.mode == 'RGBA':
-                img = img.convert('RGB')
+    With a GenerationContext the step is only started if the deadline leaves room
+    for it and `remaining_steps`, and the subprocess is killed as soon as it eats
+    into their reserve or the client disconnects; in that case GenerationCancelled
+    is raised and `remaining_steps` are recorded as skipped.
+    """
+    cmd = [
+        'python', 'generate.py',
+        '--images', *image_paths,
+        '--prompt', prompt,
+        '--outdir', output_dir,
+        '--api-key', API_KEY,
+        '--model', MODEL_NAME
+    ]
 
-            # Only resize if image exceeds max_dimension
-            if img.width > max_dimension or img.height > max_dimension:
-                # Use thumbnail to preserve aspect ratio
-                img.thumbnail((max_dimension, max_dimension), Image.Resampling.LANCZOS)
+    class ProcessResult:
+        def __init__(self, returncode, stdout, stderr):
+            self.returncode = returncode
+            self.stdout = stdout
+            self.stderr = stderr
 
-            img.save(image_path, quality=95)
-            return True
-    except Exception as e:
-        return False
+    deadline_budget = None
+    if ctx is not None:
+        try:
+            ctx.check(step)
+            deadline_budget = ctx.step_budget(step, remaining_steps)
+        except GenerationCancelled as exc:
+            generation_stats.record_cancel(exc, skipped_steps=(step, *remaining_steps))
+            print(f"[CANCEL] Skipped {step}: {exc}", flush=True)
+            raise
+    timeout = GENERATE_TIMEOUT_SECONDS if deadline_budget is None else min(GENERATE_TIMEOUT_SECONDS, deadline_budget)
+
+    # Set environment to handle UTF-8 encoding
+    env = os.environ.copy()
+    env['PYTHONIOENCODING'] = 'utf-8'
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, env=env)
+    started = time.monotonic()
+
+    while True:
+        elapsed = time.monotonic() - started
+        try:
+            stdout, stderr = proc.communicate(timeout=max(min(CANCEL_POLL_SECONDS, timeout - elapsed), 0.01))
+            break
+        except subprocess.TimeoutExpired:
+            pass
+
+        elapsed = time.monotonic() - started
+        cancel = None
+        if ctx is not None:
+            try:
+                ctx.check(step)
+                if deadline_budget is not None and elapsed >= deadline_budget:
+                    raise GenerationCancelled('deadline', step)
+            except GenerationCancelled as exc:
+                cancel = exc
+        if cancel is None and elapsed >= timeout:
+            proc.kill()
+            proc.communicate()
+            return ProcessResult(1, "", "Generation timed out")
+
+        if cancel is not None:
+            proc.kill()
+            proc.communicate()
+            generation_stats.record_cancel(cancel, killed_step=step, killed_after=elapsed,
+                                           skipped_steps=remaining_steps)
+            print(f"[CANCEL] Killed {step} after {elapsed:.1f}s: {cancel}", flush=True)
+            raise cancel
+
+    if step is not None and proc.returncode == 0:
+        generation_stats.record_step(step, time.monotonic() - started)
+    return ProcessResult(proc.returncode, stdout, stderr)
+
+
+def make_work_dir():
+    """Scratch folder for this request, removed once the response is sent"""
+    WORK_FOLDER.mkdir(parents=True, exist_ok=True)
+    work_dir = Path(tempfile.mkdtemp(dir=WORK_FOLDER))
+
+    @after_this_request
+    def remove_work_dir(response):
+        shutil.rmtree(work_dir, ignore_errors=True)
+        return response
+
+    return work_dir
+
+
+def publish_outputs(local_dir, prefix):
+    """Upload image files from local_dir to storage under prefix; returns their public URL paths"""
+    urls = []
+    for p in sorted(local_dir.iterdir()):
+        if p.is_file() and allowed_file(p.name):
+            get_storage().put_file(f"{prefix}/{p.name}", p)
+            urls.append(f"/{prefix}/{p.name}")
+    return urls
+
+
+def serve_stored(key):
+    """Serve a stored file: presigned redirect when the backend supports it, otherwise streamed"""
+    storage = get_storage()
+    try:
+        if storage.is_local:
+            path = storage.local_path(key)
+            if not path.is_file():
+                abort(404)
+            return send_file(path)
+
+        # No HEAD first: a redirect target answers 404 itself and open() raises FileNotFoundError
+        if STORAGE_REDIRECT:
+            url = storage.url(key, STORAGE_URL_EXPIRES)
+            if url:
+                return redirect(url)
+        body = storage.open(key)
+    except (ValueError, FileNotFoundError):
+        abort(404)
+
+    mimetype = mimetypes.guess_type(key)[0] or 'application/octet-stream'
+    return send_file(body, mimetype=mimetype, download_name=Path(key).name)
 
 
 @app.route('/')
@@ -262,12 +513,14 @@ def index():
 def run_generation():
     # input_image: required
     # banknote_choice: required (select which banknote style to use)
+    # X-Request-Timeout header: optional, shortens the generation deadline (seconds)
+    ctx = GenerationContext(request.environ, request.headers)
 
-    # Verify upload folder exists and is writable
-    if not UPLOAD_FOLDER.exists():
-        UPLOAD_FOLDER.mkdir(parents=True, exist_ok=True)
-    if not os.access(UPLOAD_FOLDER, os.W_OK):
-        return jsonify({"error": f"Uploads folder is not writable: {UPLOAD_FOLDER}"}), 500
+    # Verify scratch folder exists and is writable
+    if not WORK_FOLDER.exists():
+        WORK_FOLDER.mkdir(parents=True, exist_ok=True)
+    if not os.access(WORK_FOLDER, os.W_OK):
+        return jsonify({"error": f"Work folder is not writable: {WORK_FOLDER}"}), 500
 
     if 'input_image' not in request.files:
         return jsonify({"error": "input_image field is required"}), 400
@@ -297,10 +550,11 @@ def run_generation():
     if not sample_path.exists():
         return jsonify({"error": f"Sample image {selected_banknote['sample_image']} not found"}), 400
 
-    # Save input image
+    # Save input image to this request's scratch folder; it is published to storage once normalized
+    work_dir = make_work_dir()
     input_fname = secure_filename(input_file.filename)
     input_id = f"{uuid.uuid4().hex}_{input_fname}"
-    input_path = UPLOAD_FOLDER / input_id
+    input_path = work_dir / input_id
 
     input_file.save(input_path)
 
@@ -309,17 +563,37 @@ def run_generation():
         return jsonify({"error": f"Failed to save uploaded file to {input_path}"}), 500
 
     # Optimize input image for Gemini Flash processing (includes EXIF correction)
-    optimize_image_for_gemini(input_path)
+    try:
+        ctx.check('normalize')
+        normalized = normalize_upload(input_path, ctx)
+        ctx.check('normalize')
+    except GenerationCancelled as exc:
+        generation_stats.record_cancel(exc, skipped_steps=('step1', 'step2'))
+        print(f"[CANCEL] Abandoned generation before step 1: {exc}", flush=True)
+        return cancelled_response(exc)
+    except BrokenProcessPool:
+        print(f"[IMAGE POOL] {input_fname} killed an image worker twice, rejecting upload", flush=True)
+        return jsonify({"error": f"Input image could not be processed: {input_fname}"}), 400
+
+    if not normalized:
+        # Modes the optimizer cannot re-encode as-is (e.g. a palette PNG named .jpg) still go to Gemini unchanged
+        print(f"[IMAGE POOL] Could not optimize {input_fname}, using the original file", flush=True)
+        if not is_readable_image(input_path):
+            return jsonify({"error": f"Input image could not be read: {input_fname}"}), 400
 
     # Final verification: Check that input file still exists after optimization
     if not input_path.exists():
         return jsonify({"error": f"Input file was lost during processing: {input_fname}"}), 500
 
-    # Prepare unique output folder for this run with step1 and step2 subfolders
+    try:
+        get_storage().put_file(f"uploads/{input_id}", input_path)
+    except Exception as e:
+        return jsonify({"error": f"Failed to store uploaded file: {str(e)}"}), 500
+
+    # Prepare unique scratch output folders for this run; results are published under outputs/<run_id>/
     run_id = uuid.uuid4().hex
-    this_outdir = OUTPUT_FOLDER / run_id
-    step1_dir = this_outdir / "step1"
-    step2_dir = this_outdir / "step2"
+    step1_dir = work_dir / "step1"
+    step2_dir = work_dir / "step2"
     step1_dir.mkdir(parents=True, exist_ok=True)
     step2_dir.mkdir(parents=True, exist_ok=True)
 
@@ -327,89 +601,97 @@ def run_generation():
         return jsonify({"error": "Server missing GEMINI_API_KEY environment variable"}), 500
 
     try:
-        # Step 1: Apply banknote style to input image
-        style_prompt = f"{selected_banknote['style_description']}. Edit the image to precisely match this banknote style, maintaining high detail, engraving techniques, and all artistic elements without adding extra frames or borders."
-
-        print(f"Step 1: Applying style {selected_banknote['name']} to input image", flush=True)
-
-        # Validate input image before proceeding
-        if not os.path.exists(input_path):
-            return jsonify({"error": f"Input image file not found: {input_path}"}), 500
-
-        # Pass the input image to step 1
-        step1_images = [str(input_path)]
-
-        step1_result = run_generate_command(
-            style_prompt,
-            step1_images,
-            str(step1_dir)
-        )
-
-        if step1_result.returncode != 0:
-            return jsonify({
-                "error": "Step 1 (style application) failed",
-                "stdout": step1_result.stdout,
-                "stderr": step1_result.stderr,
-                "returncode": step1_result.returncode
-            }), 500
-
-        # Check if step 1 generated the styled image
-        styled_image_path = step1_dir / "styled_image.png"
-        if not styled_image_path.exists():
-            return jsonify({"error": "Step 1 did not generate styled image"}), 500
-
-        print(f"Step 1 completed successfully, styled image saved to {styled_image_path}")
-
-        # Step 2: Integrate styled image into banknote
-        integration_prompt = """Insert the first image as the main central content in the bank note. Ensure  the first image is at the center of the banknote and neatly enclosed  between the banknote frames. Make it look borderlessly integrated into  the banknote and preserving all banknote text and frames overlaid on the top of the inserted image."""
-
-        print(f"Step 2: Integrating styled image into {selected_banknote['name']}")
-        step2_result = run_generate_command(
-            integration_prompt,
-            [str(styled_image_path), str(sample_path)],
-            str(step2_dir)
-        )
-
-        if step2_result.returncode != 0:
-            return jsonify({
-                "error": "Step 2 (banknote integration) failed",
-                "stdout": step2_result.stdout,
-                "stderr": step2_result.stderr,
-                "returncode": step2_result.returncode
-            }), 500
-
-        print(f"Step 2 completed successfully")
-
-        # Collect results
-        result = {
-            'returncode': 0,
-            'run_id': run_id,
-            'stdout': f"Step 1: {step1_result.stdout}\nStep 2: {step2_result.stdout}",
-            'stderr': f"Step 1: {step1_result.stderr}\nStep 2: {step2_result.stderr}",
-            'outputs': [],
-            'step_outputs': {
-                'step1': [],
-                'step2': []
-            },
-            'input_image_path': f"/uploads/{input_id}",
-            'input_filename': input_fname
-        }
-
-        # List step1 outputs
-        for p in sorted(step1_dir.iterdir()):
-            if p.is_file() and allowed_file(p.name):
-                result['step_outputs']['step1'].append(f"/outputs/{run_id}/step1/{p.name}")
-
-        # List step2 outputs (final results)
-        for p in sorted(step2_dir.iterdir()):
-            if p.is_file() and allowed_file(p.name):
-                result['step_outputs']['step2'].append(f"/outputs/{run_id}/step2/{p.name}")
-                result['outputs'].append(f"/outputs/{run_id}/step2/{p.name}")
-
-        result['banknote_used'] = selected_banknote['name']
-
-        return jsonify(result)
-
+        with generation_slot(ctx, ('step1', 'step2')):
+            # Step 1: Apply banknote style to input image
+            style_prompt = f"{selected_banknote['style_description']}. Edit the image to precisely match this banknote style, maintaining high detail, engraving techniques, and all artistic elements without adding extra frames or borders."
+
+            print(f"Step 1: Applying style {selected_banknote['name']} to input image", flush=True)
+
+            # Validate input image before proceeding
+            if not os.path.exists(input_path):
+                return jsonify({"error": f"Input image file not found: {input_path}"}), 500
+
+            # Pass the input image to step 1
+            step1_images = [str(input_path)]
+
+            step1_result = run_generate_command(
+                style_prompt,
+                step1_images,
+                str(step1_dir),
+                ctx=ctx,
+                step='step1',
+                remaining_steps=('step2',)
+            )
+
+            if step1_result.returncode != 0:
+                return jsonify({
+                    "error": "Step 1 (style application) failed",
+                    "stdout": step1_result.stdout,
+                    "stderr": step1_result.stderr,
+                    "returncode": step1_result.returncode
+                }), 500
+
+            # Check if step 1 generated the styled image
+            styled_image_path = step1_dir / "styled_image.png"
+            if not styled_image_path.exists():
+                return jsonify({"error": "Step 1 did not generate styled image"}), 500
+
+            # Publish step 1 right away so /regenerate-step2 works on any node even if step 2 fails
+            step1_urls = publish_outputs(step1_dir, f"outputs/{run_id}/step1")
+
+            print(f"Step 1 completed successfully, styled image saved to outputs/{run_id}/step1")
+
+            # Step 2: Integrate styled image into banknote
+            integration_prompt = """Insert the first image as the main central content in the bank note. Ensure  the first image is at the center of the banknote and neatly enclosed  between the banknote frames. Make it look borderlessly integrated into  the banknote and preserving all banknote text and frames overlaid on the top of the inserted image."""
+
+            print(f"Step 2: Integrating styled image into {selected_banknote['name']}")
+            step2_result = run_generate_command(
+                integration_prompt,
+                [str(styled_image_path), str(sample_path)],
+                str(step2_dir),
+                ctx=ctx,
+                step='step2'
+            )
+
+            if step2_result.returncode != 0:
+                return jsonify({
+                    "error": "Step 2 (banknote integration) failed",
+                    "stdout": step2_result.stdout,
+                    "stderr": step2_result.stderr,
+                    "returncode": step2_result.returncode
+                }), 500
+
+            print(f"Step 2 completed successfully")
+
+            # Collect results
+            result = {
+                'returncode': 0,
+                'run_id': run_id,
+                'stdout': f"Step 1: {step1_result.stdout}\nStep 2: {step2_result.stdout}",
+                'stderr': f"Step 1: {step1_result.stderr}\nStep 2: {step2_result.stderr}",
+                'outputs': [],
+                'step_outputs': {
+                    'step1': [],
+                    'step2': []
+                },
+                'input_image_path': f"/uploads/{input_id}",
+                'input_filename': input_fname
+            }
+
+            # List step1 outputs
+            result['step_outputs']['step1'].extend(step1_urls)
+
+            # Publish and list step2 outputs (final results)
+            step2_urls = publish_outputs(step2_dir, f"outputs/{run_id}/step2")
+            result['step_outputs']['step2'].extend(step2_urls)
+            result['outputs'].extend(step2_urls)
+
+            result['banknote_used'] = selected_banknote['name']
+
+            return jsonify(result)
+
+    except GenerationCancelled as exc:
+        return cancelled_response(exc)
     except subprocess.TimeoutExpired:
         return jsonify({"error": "Generation timed out"}), 500
     except Exception as e:
@@ -423,6 +705,8 @@ def regenerate_step2():
     This keeps the styled image from step1 and only runs step2 again.
     """
     # Required fields: run_id, banknote_choice
+    # X-Request-Timeout header: optional, shortens the generation deadline (seconds)
+    ctx = GenerationContext(request.environ, request.headers)
     run_id = request.form.get('run_id')
     banknote_choice = request.form.get('banknote_choice')
 
@@ -449,73 +733,86 @@ def regenerate_step2():
         return jsonify({"error": f"Sample image {selected_banknote['sample_image']} not found"}), 400
 
     # Validate that the run_id exists and step1 output is available
-    step1_dir = OUTPUT_FOLDER / run_id / "step1"
-    if not step1_dir.exists():
+    if secure_filename(run_id) != run_id:
+        return jsonify({"error": f"run_id '{run_id}' not found or step1 output missing"}), 400
+    step1_prefix = f"outputs/{run_id}/step1"
+    step1_keys = get_storage().list(step1_prefix)
+    if not step1_keys:
         return jsonify({"error": f"run_id '{run_id}' not found or step1 output missing"}), 400
 
     # Check if step1 styled image exists
-    styled_image_path = step1_dir / "styled_image.png"
-    if not styled_image_path.exists():
+    styled_image_key = f"{step1_prefix}/styled_image.png"
+    if styled_image_key not in step1_keys:
         return jsonify({"error": f"Step 1 styled image not found for run_id '{run_id}'"}), 400
 
     if not API_KEY:
         return jsonify({"error": "Server missing GEMINI_API_KEY environment variable"}), 500
 
     try:
-        # Create new step2 directory with timestamp for this regeneration
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        new_step2_dir = OUTPUT_FOLDER / run_id / f"step2_{timestamp}"
-        new_step2_dir.mkdir(parents=True, exist_ok=True)
-
-        # Step 2: Integrate existing styled image into banknote
-        integration_prompt = """Remove the central content inside the banknote. Then insert the first image as the main central content in the banknote. Keep both images orientations intact. Ensure the first image is at the center of the banknote and neatly enclosed between the banknote frames. make it look boundlessly integrated to the banknote."""
-
-        print(f"Step 2 regeneration: Integrating styled image into {selected_banknote['name']} for run_id {run_id}", flush=True)
-
-        step2_result = run_generate_command(
-            integration_prompt,
-            [str(styled_image_path), str(sample_path)],
-            str(new_step2_dir)
-        )
-
-        if step2_result.returncode != 0:
-            return jsonify({
-                "error": "Step 2 regeneration failed",
-                "stdout": step2_result.stdout,
-                "stderr": step2_result.stderr,
-                "returncode": step2_result.returncode
-            }), 500
-
-        print(f"Step 2 regeneration completed successfully")
-
-        # Collect results
-        result = {
-            'returncode': 0,
-            'run_id': run_id,
-            'regeneration_timestamp': timestamp,
-            'stdout': step2_result.stdout,
-            'stderr': step2_result.stderr,
-            'outputs': [],
-            'step_outputs': {
-                'step1': [],  # Keep existing step1 outputs
-                'step2': []   # New step2 outputs
-            },
-            'banknote_used': selected_banknote['name']
-        }
-
-        # List existing step1 outputs
-        for p in sorted(step1_dir.iterdir()):
-            if p.is_file() and allowed_file(p.name):
-                result['step_outputs']['step1'].append(f"/outputs/{run_id}/step1/{p.name}")
-
-        # List new step2 outputs (final results)
-        for p in sorted(new_step2_dir.iterdir()):
-            if p.is_file() and allowed_file(p.name):
-                result['step_outputs']['step2'].append(f"/outputs/{run_id}/step2_{timestamp}/{p.name}")
-                result['outputs'].append(f"/outputs/{run_id}/step2_{timestamp}/{p.name}")
-
-        return jsonify(result)
-
+        with generation_slot(ctx, ('step2',)):
+            # Private copy of the styled image for generate.py; cache entries can be evicted while step 2 runs
+            work_dir = make_work_dir()
+            styled_image_path = get_storage().download(styled_image_key, work_dir / "styled_image.png")
+
+            # Create new step2 directory with timestamp for this regeneration;
+            # the suffix keeps two regenerations of a run in the same second apart
+            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+            step2_name = f"step2_{timestamp}_{uuid.uuid4().hex[:8]}"
+            new_step2_dir = work_dir / step2_name
+            new_step2_dir.mkdir(parents=True, exist_ok=True)
+
+            # Step 2: Integrate existing styled image into banknote
+            integration_prompt = """Remove the central content inside the banknote. Then insert the first image as the main central content in the banknote. Keep both images orientations intact. Ensure the first image is at the center of the banknote and neatly enclosed between the banknote frames. make it look boundlessly integrated to the banknote."""
+
+            print(f"Step 2 regeneration: Integrating styled image into {selected_banknote['name']} for run_id {run_id}", flush=True)
+
+            step2_result = run_generate_command(
+                integration_prompt,
+                [str(styled_image_path), str(sample_path)],
+                str(new_step2_dir),
+                ctx=ctx,
+                step='step2'
+            )
+
+            if step2_result.returncode != 0:
+                return jsonify({
+                    "error": "Step 2 regeneration failed",
+                    "stdout": step2_result.stdout,
+                    "stderr": step2_result.stderr,
+                    "returncode": step2_result.returncode
+                }), 500
+
+            print(f"Step 2 regeneration completed successfully")
+
+            # Collect results
+            result = {
+                'returncode': 0,
+                'run_id': run_id,
+                'regeneration_timestamp': timestamp,
+                'stdout': step2_result.stdout,
+                'stderr': step2_result.stderr,
+                'outputs': [],
+                'step_outputs': {
+                    'step1': [],  # Keep existing step1 outputs
+                    'step2': []   # New step2 outputs
+                },
+                'banknote_used': selected_banknote['name']
+            }
+
+            # List existing step1 outputs
+            for key in step1_keys:
+                if allowed_file(key):
+                    result['step_outputs']['step1'].append(f"/{key}")
+
+            # Publish and list new step2 outputs (final results)
+            step2_urls = publish_outputs(new_step2_dir, f"outputs/{run_id}/{step2_name}")
+            result['step_outputs']['step2'].extend(step2_urls)
+            result['outputs'].extend(step2_urls)
+
+            return jsonify(result)
+
+    except GenerationCancelled as exc:
+        return cancelled_response(exc)
     except subprocess.TimeoutExpired:
         return jsonify({"error": "Step 2 regeneration timed out"}), 500
     except Exception as e:
@@ -526,9 +823,7 @@ def regenerate_step2():
 @app.route('/uploads/<filename>')
 def serve_upload(filename):
     safe = secure_filename(filename)
-    if not (UPLOAD_FOLDER / safe).exists():
-        abort(404)
-    return send_from_directory(UPLOAD_FOLDER, safe)
+    return serve_stored(f"uploads/{safe}")
 
 # Static serving of sample images
 @app.route('/samples/<filename>')
@@ -542,10 +837,7 @@ def serve_sample(filename):
 @app.route('/outputs/<run_id>/<filename>')
 def serve_output(run_id, filename):
     safe = secure_filename(filename)
-    folder = OUTPUT_FOLDER / run_id
-    if not (folder.exists() and (folder / safe).exists()):
-        abort(404)
-    return send_from_directory(folder, safe)
+    return serve_stored(f"outputs/{secure_filename(run_id)}/{safe}")
 
 # Static serving of step output images
 @app.route('/outputs/<run_id>/<step>/<filename>')
@@ -553,29 +845,34 @@ def serve_step_output(run_id, step, filename):
     safe = secure_filename(filename)
     if step not in ['step1', 'step2']:
         abort(404)
-    folder = OUTPUT_FOLDER / run_id / step
-    if not (folder.exists() and (folder / safe).exists()):
-        abort(404)
-    return send_from_directory(folder, safe)
+    return serve_stored(f"outputs/{secure_filename(run_id)}/{step}/{safe}")
 
 # Static serving of timestamped step2 output images (for regeneration)
 @app.route('/outputs/<run_id>/step2_<timestamp>/<filename>')
 def serve_timestamped_step_output(run_id, timestamp, filename):
     safe = secure_filename(filename)
-    folder = OUTPUT_FOLDER / run_id / f"step2_{timestamp}"
-    if not (folder.exists() and (folder / safe).exists()):
-        abort(404)
-    return send_from_directory(folder, safe)
+    return serve_stored(f"outputs/{secure_filename(run_id)}/step2_{secure_filename(timestamp)}/{safe}")
+
+@app.route('/metrics/generation')
+def generation_metrics():
+    """Queue depth, cancellations and model time saved by dropping abandoned work"""
+    return jsonify(generation_stats.snapshot())
+
+@app.route('/metrics/images')
+def image_metrics():
+    """Image process pool queue depth and task timings"""
+    return jsonify(get_image_pool().snapshot())
 
 @app.route('/hello')
 def hello():
     return jsonify({"message": "Hello, World!"})
 
-if __name__ == '__main__':
+def main():
+    """Start the cleanup scheduler and the development server (see server.py)"""
     # Configure scheduler for automatic cleanup
     vn_tz = pytz.timezone('Asia/Ho_Chi_Minh')
     scheduler = BackgroundScheduler(timezone=vn_tz)
-    
+
     # Schedule cleanup at 3:00 AM Vietnam time every day
     scheduler.add_job(
         func=cleanup_old_files,
@@ -584,15 +881,21 @@ if __name__ == '__main__':
         name='Daily cleanup of old files',
         replace_existing=True
     )
-    
+
     scheduler.start()
     print(f"[SCHEDULER] Cleanup job scheduled at 3:00 AM Vietnam time (UTC+7)", flush=True)
     print(f"[SCHEDULER] Files older than {CLEANUP_AGE_HOURS} hours will be deleted", flush=True)
-    
+
     try:
         # for development only
         port = int(os.environ.get('FLASK_PORT', 5000))
         app.run(host='0.0.0.0', port=port, debug=True)
     except (KeyboardInterrupt, SystemExit):
         scheduler.shutdown()
-        print("[SCHEDULER] Scheduler stopped", flush=True)
\ No newline at end of file
+        print("[SCHEDULER] Scheduler stopped", flush=True)
+
+
+if __name__ == '__main__':
+    # Prefer `python server.py`: image pool workers re-run the main script, and
+    # with app.py as the main script each of them imports Flask again.
+    main()
@@ -0,0 +1,351 @@
+# image_ops.py
+# CPU-bound image transforms and the process pool that runs them off the request threads.
+# Everything here must stay importable without Flask: pool workers are spawned and
+# only import this module.
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from PIL import Image
+
+
+def _timed_call(func, image_path, args):
+    """Runs inside the worker process; returns the result and the time spent on it"""
+    started = time.perf_counter()
+    result = func(image_path, *args)
+    return result, time.perf_counter() - started
+
+
+class ImageWorkerPool:
+    """
+    Size-bounded process pool for image transforms.
+
+    Transforms work on files that are already on disk (uploads are saved before
+    processing), so only the path crosses the process boundary and the worker
+    reads the image and atomically replaces it - no pixel data is pickled. Images
+    at or below `inline_max_bytes` are processed inline, where process hand-off
+    would cost more than the transform itself. At most `max_pending` tasks are
+    queued or running; further callers wait for a free slot. If a worker dies
+    (e.g. OOM-killed on a decompression bomb) the broken executor is discarded
+    and the next task starts a fresh one; `run(..., isolated=True)` gives a task
+    its own single-use worker, so a retry cannot be killed by someone else's image.
+    """
+
+    def __init__(self, workers, max_pending, inline_max_bytes):
+        self.workers = workers
+        self.max_pending = max(max_pending, workers, 1)
+        self.inline_max_bytes = inline_max_bytes
+        self._executor = None
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self.lock = threading.Lock()
+        self.queued = 0
+        self.running = 0
+        self.pooled_tasks = 0
+        self.inline_tasks = 0
+        self.cancelled_tasks = 0
+        self.failed_tasks = 0
+        self.task_seconds_total = 0.0
+        self.task_seconds_max = 0.0
+        self.wait_seconds_total = 0.0
+        self.broken = False  # last executor died and has not been replaced yet
+        self.restarts = 0
+        self.isolated_tasks = 0
+
+    @staticmethod
+    def _new_executor(workers):
+        # spawn, not fork: forking a multi-threaded Flask worker can copy held locks
+        return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+
+    def _get_executor(self):
+        with self.lock:
+            if self._executor is None:
+                self._executor = self._new_executor(self.workers)
+                if self.broken:
+                    self.broken = False
+                    self.restarts += 1
+            return self._executor
+
+    def _discard_executor(self, executor):
+        """Drop a broken executor so the next task gets a new one"""
+        with self.lock:
+            if self._executor is not executor:
+                return  # another thread already replaced it
+            self._executor = None
+            self.broken = True
+        print("[IMAGE POOL] Worker process died, pool will be restarted", flush=True)
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def _submit(self, func, image_path, args):
+        """Submit to the current executor, replacing it once if it turns out to be broken; returns (executor, future)"""
+        executor = self._get_executor()
+        try:
+            return executor, executor.submit(_timed_call, func, image_path, args)
+        except (BrokenProcessPool, RuntimeError):
+            # RuntimeError: another thread shut this executor down after finding it broken
+            self._discard_executor(executor)
+            executor = self._get_executor()
+            return executor, executor.submit(_timed_call, func, image_path, args)
+
+    def _record_task(self, seconds, pooled, wait=0.0):
+        with self.lock:
+            if pooled:
+                self.pooled_tasks += 1
+                self.wait_seconds_total += wait
+            else:
+                self.inline_tasks += 1
+            self.task_seconds_total += seconds
+            self.task_seconds_max = max(self.task_seconds_max, seconds)
+
+    def run(self, func, image_path, *args, cancel_check=None, poll_seconds=0.5, isolated=False):
+        """
+        Run `func(image_path, *args)` and return its result, in a worker process
+        for large images and inline for small ones.
+
+        `cancel_check` is called every `poll_seconds` while waiting; if it raises,
+        a task that has not started yet is cancelled and the exception propagates.
+        With `isolated`, a pooled task runs in a fresh single-worker executor that is
+        shut down afterwards, so BrokenProcessPool means this task killed its worker.
+        """
+        try:
+            size = os.path.getsize(image_path)
+        except OSError:
+            size = 0
+
+        if self.workers <= 0 or size <= self.inline_max_bytes:
+            result, seconds = _timed_call(func, image_path, args)
+            self._record_task(seconds, pooled=False)
+            return result
+
+        submitted = time.perf_counter()
+        with self.lock:
+            self.queued += 1
+        try:
+            while not self._slots.acquire(timeout=poll_seconds):
+                if cancel_check:
+                    cancel_check()
+        except BaseException:
+            with self.lock:
+                self.queued -= 1
+                self.cancelled_tasks += 1
+            raise
+
+        try:
+            if isolated:
+                executor = self._new_executor(1)
+                future = executor.submit(_timed_call, func, image_path, args)
+                with self.lock:
+                    self.isolated_tasks += 1
+            else:
+                executor, future = self._submit(func, image_path, args)
+        except BaseException:
+            self._slots.release()
+            with self.lock:
+                self.queued -= 1
+                self.failed_tasks += 1
+            raise
+
+        state = {'started': False, 'done': False}
+
+        # The executor has no "started" hook; treat the first poll that sees it running as the start
+        def on_running():
+            with self.lock:
+                if state['started'] or state['done']:
+                    return
+                state['started'] = True
+                self.queued -= 1
+                self.running += 1
+
+        def on_done(f: Future):
+            self._slots.release()
+            with self.lock:
+                state['done'] = True
+                if state['started']:
+                    self.running -= 1
+                else:
+                    self.queued -= 1
+                if f.cancelled():
+                    self.cancelled_tasks += 1
+                elif f.exception() is not None:
+                    self.failed_tasks += 1
+
+        future.add_done_callback(on_done)
+
+        try:
+            while True:
+                if future.running():
+                    on_running()
+                try:
+                    result, seconds = future.result(timeout=poll_seconds)
+                    break
+                except TimeoutError:
+                    pass
+                except BrokenProcessPool:
+                    if not isolated:
+                        self._discard_executor(executor)
+                    raise
+                if cancel_check:
+                    try:
+                        cancel_check()
+                    except BaseException:
+                        future.cancel()
+                        raise
+        finally:
+            if isolated:
+                executor.shutdown(wait=False, cancel_futures=True)
+
+        self._record_task(seconds, pooled=True,
+                          wait=max(time.perf_counter() - submitted - seconds, 0.0))
+        return result
+
+    def snapshot(self):
+        with self.lock:
+            completed = self.pooled_tasks + self.inline_tasks
+            return {
+                'workers': self.workers,
+                'max_pending': self.max_pending,
+                'inline_max_bytes': self.inline_max_bytes,
+                'queue_depth': self.queued,
+                'running': self.running,
+                'pooled_tasks': self.pooled_tasks,
+                'inline_tasks': self.inline_tasks,
+                'cancelled_tasks': self.cancelled_tasks,
+                'failed_tasks': self.failed_tasks,
+                'broken': self.broken,
+                'restarts': self.restarts,
+                'isolated_tasks': self.isolated_tasks,
+                'avg_task_seconds': round(self.task_seconds_total / completed, 3) if completed else 0.0,
+                'max_task_seconds': round(self.task_seconds_max, 3),
+                'avg_wait_seconds': round(self.wait_seconds_total / self.pooled_tasks, 3) if self.pooled_tasks else 0.0,
+            }
+
+    def shutdown(self):
+        with self.lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _save_replacing(img, image_path, **params):
+    """
+    Save `img` over `image_path` via a temp file and os.replace, so a worker that
+    dies mid-encode never leaves a truncated image behind.
+    """
+    root, ext = os.path.splitext(str(image_path))
+    tmp_path = f"{root}.{os.getpid()}.tmp{ext}"  # keep the extension: Pillow picks the format from it
+    try:
+        img.save(tmp_path, **params)
+        os.replace(tmp_path, image_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def is_readable_image(image_path):
+    """True if Pillow recognises the file as an image; only the header is read"""
+    try:
+        with Image.open(image_path):
+            return True
+    except Exception:
+        return False
+
+
+def fix_image_orientation(image_path):
+    """
+    Fix image orientation based on EXIF data to prevent iPhone rotation issues.
+    iPhone photos contain EXIF orientation metadata that browsers don't interpret,
+    causing images to appear rotated when uploaded.
+
+    Args:
+        image_path: Path to image file to fix orientation for
+
+    Returns:
+        True if orientation was fixed or no fix needed, False if error occurred
+    """
+    try:
+        with Image.open(image_path) as img:
+            exif = img._getexif()
+            if not exif:
+                return True
+
+            orientation_key = 0x0112
+            if orientation_key not in exif:
+                return True
+
+            orientation = exif[orientation_key]
+            orientation_fixed = False
+
+            # Apply rotation based on EXIF orientation
+            if orientation == 1:
+                pass  # Normal (no rotation)
+            elif orientation == 2:
+                img = img.transpose(Image.Transpose.FLIP_LEFT_RIGHT)
+                orientation_fixed = True
+            elif orientation == 3:
+                img = img.transpose(Image.Transpose.ROTATE_180)
+                orientation_fixed = True
+            elif orientation == 4:
+                img = img.transpose(Image.Transpose.FLIP_TOP_BOTTOM)
+                orientation_fixed = True
+            elif orientation == 5:
+                img = img.transpose(Image.Transpose.ROTATE_270).transpose(Image.Transpose.FLIP_LEFT_RIGHT)
+                orientation_fixed = True
+            elif orientation == 6:
+                img = img.transpose(Image.Transpose.ROTATE_270)
+                orientation_fixed = True
+            elif orientation == 7:
+                img = img.transpose(Image.Transpose.ROTATE_270).transpose(Image.Transpose.FLIP_TOP_BOTTOM)
+                orientation_fixed = True
+            elif orientation == 8:
+                img = img.transpose(Image.Transpose.ROTATE_90)
+                orientation_fixed = True
+            else:
+                return True  # Unknown orientation, skip processing
+
+            # Save the image if we made changes
+            if orientation_fixed:
+                _save_replacing(img, image_path, quality=95)
+
+            return True
+
+    except Exception:
+        return False
+
+
+def optimize_image_for_gemini(image_path, max_dimension=1024):
+    """
+    Optimize image for Gemini Flash processing by downscaling if too large.
+    Only resizes if width or height exceeds max_dimension (default 1024px).
+    Preserves aspect ratio using thumbnail() to avoid distortion.
+
+    Based on Gemini Flash documentation:
+    - Images ≤1024×1024: optimal quality and processing speed
+    - Images >1024×1024: automatically tiled (slower, more tokens)
+
+    Args:
+        image_path: Path to image file to optimize
+        max_dimension: Maximum width/height in pixels (default 1024)
+
+    Returns:
+        True if successful, False if error occurred
+    """
+    try:
+        # Step 1: Fix EXIF orientation to prevent iPhone rotation issues
+        fix_image_orientation(image_path)
+
+        # Step 2: Optimize image size
+        with Image.open(image_path) as img:
+            # Convert RGBA to RGB if needed
+            if img.mode == 'RGBA':
+                img = img.convert('RGB')
+
+            # Only resize if image exceeds max_dimension
+            if img.width > max_dimension or img.height > max_dimension:
+                # Use thumbnail to preserve aspect ratio
+                img.thumbnail((max_dimension, max_dimension), Image.Resampling.LANCZOS)
+
+            _save_replacing(img, image_path, quality=95)
+            return True
+    except Exception as e:
+        return False
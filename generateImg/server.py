@@ -0,0 +1,10 @@
+# server.py
+# Entry point for running the service (used by the dockerfile).
+# Image pool workers are spawned processes that re-run the main script before
+# unpickling their task, so this file must not import app.py at module level:
+# that would load Flask, the scheduler and the app state in every worker.
+# Keep everything under the __main__ guard.
+
+if __name__ == '__main__':
+    from app import main
+    main()
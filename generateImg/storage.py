@@ -0,0 +1,370 @@
+# storage.py
+# Storage backends for uploads and generated outputs.
+#
+# Keys look like "uploads/<input_id>" or "outputs/<run_id>/step1/styled_image.png":
+# a namespace, an id (upload id or run_id) and an optional path inside it.
+# All nodes behind the load balancer must point at the same backend so that a
+# run_id created on one node can be served or regenerated on any other.
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def split_key(key):
+    """Split "namespace/id/rest" into its parts, rejecting anything that could escape the root"""
+    parts = key.split('/')
+    if len(parts) < 2 or any(p in ('', '.', '..') or '\\' in p for p in parts):
+        raise ValueError(f"Invalid storage key: {key}")
+    return parts[0], parts[1], parts[2:]
+
+
+def shard_of(ident):
+    """Two-level hash shard ("ab/cd") so no directory holds more than a few hundred entries"""
+    digest = hashlib.sha1(ident.encode('utf-8')).hexdigest()
+    return digest[:2], digest[2:4]
+
+
+class LocalShardedStorage:
+    """
+    Hash-sharded directory layout on local (or shared network) disk:
+    <root>/<namespace>/<ab>/<cd>/<id>/<rest>. Files of one run stay together,
+    so cleanup can still drop a whole run folder at once.
+    """
+
+    is_local = True
+
+    def __init__(self, root):
+        self.root = Path(root).resolve()
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def local_path(self, key):
+        namespace, ident, rest = split_key(key)
+        return self.root.joinpath(namespace, *shard_of(ident), ident, *rest)
+
+    def exists(self, key):
+        return self.local_path(key).is_file()
+
+    def open(self, key):
+        return open(self.local_path(key), 'rb')
+
+    def save(self, key, fileobj):
+        """Stream `fileobj` into `key`; the file only appears once fully written"""
+        path = self.local_path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(tmp_path, 'wb') as f:
+            shutil.copyfileobj(fileobj, f, CHUNK_SIZE)
+        os.replace(tmp_path, path)
+
+    def put_file(self, key, source_path):
+        with open(source_path, 'rb') as f:
+            self.save(key, f)
+
+    def download(self, key, dest_path):
+        """Copy `key` to dest_path, a file owned by the caller for as long as it needs it"""
+        shutil.copyfile(self.local_path(key), dest_path)
+        return dest_path
+
+    def list(self, prefix):
+        """Keys of the files directly under `prefix` ("namespace/id/sub/")"""
+        folder = self.local_path(prefix.rstrip('/'))
+        if not folder.is_dir():
+            return []
+        return [f"{prefix.rstrip('/')}/{p.name}" for p in sorted(folder.iterdir()) if p.is_file()]
+
+    def url(self, key, expires=3600):
+        return None
+
+    def cleanup(self, max_age_seconds, log=print):
+        """Delete whole upload files / run folders older than max_age_seconds; returns (items, bytes)"""
+        now = time.time()
+        deleted = 0
+        freed = 0
+        for item in self.root.glob('*/*/*/*'):
+            try:
+                if now - item.stat().st_mtime <= max_age_seconds:
+                    continue
+                if item.is_dir():
+                    size = sum(f.stat().st_size for f in item.rglob('*') if f.is_file())
+                    shutil.rmtree(item)
+                else:
+                    size = item.stat().st_size
+                    item.unlink()
+                deleted += 1
+                freed += size
+                log(f"[CLEANUP] Deleted {item.relative_to(self.root)} ({size / 1024:.2f} KB)")
+            except Exception as e:
+                log(f"[CLEANUP] Error deleting {item}: {e}")
+        return deleted, freed
+
+
+class ReadThroughCache:
+    """
+    Small LRU cache of remote objects on local disk, to avoid refetching hot
+    images. Cached files may be evicted at any time, so callers that need a
+    file for longer (e.g. as generate.py input) copy it out first.
+    The on-disk size is scanned once at startup and tracked in memory after that.
+    """
+
+    def __init__(self, root, max_bytes):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # path -> size, least recently used first
+        self._total = 0
+
+        existing = []
+        for p in self.root.glob('*/*'):
+            if not p.is_file():
+                continue
+            if p.name.startswith('.'):
+                p.unlink(missing_ok=True)  # temp file left by an interrupted fill
+                continue
+            st = p.stat()
+            existing.append((st.st_mtime, st.st_size, p))
+        for _, size, p in sorted(existing, key=lambda e: e[0]):
+            self._entries[p] = size
+            self._total += size
+        with self._lock:
+            self._evict_locked()
+
+    def path_for(self, key):
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return self.root / digest[:2] / f"{digest}{Path(key).suffix}"
+
+    def get(self, key):
+        path = self.path_for(key)
+        with self._lock:
+            if path not in self._entries:
+                return None
+            self._entries.move_to_end(path)
+            return path
+
+    def fill(self, key, fileobj):
+        tmp_path, f = self.begin_fill(key)
+        with f:
+            shutil.copyfileobj(fileobj, f, CHUNK_SIZE)
+        return self.commit(key, tmp_path)
+
+    def begin_fill(self, key):
+        """Open a temp file to write `key` into; pass it to commit() once complete, or delete it"""
+        path = self.path_for(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(prefix=f".{path.name}.", suffix='.tmp', dir=path.parent)
+        return Path(tmp_path), os.fdopen(fd, 'wb')
+
+    def commit(self, key, tmp_path):
+        path = self.path_for(key)
+        size = tmp_path.stat().st_size
+        os.replace(tmp_path, path)
+        with self._lock:
+            self._total += size - self._entries.pop(path, 0)
+            self._entries[path] = size
+            self._evict_locked()
+        return path
+
+    def _evict_locked(self):
+        # Never evict the most recent entry, even if it alone exceeds max_bytes
+        while self._total > self.max_bytes and len(self._entries) > 1:
+            path, size = self._entries.popitem(last=False)
+            self._total -= size
+            try:
+                path.unlink()
+            except OSError:
+                pass
+
+
+class _CacheFillingReader:
+    """
+    File-like wrapper around an object body that copies what is read into the
+    cache. The copy is committed only if the body is read to the end; a client
+    that disconnects halfway leaves nothing behind. Cache write errors only
+    stop the copy, never the read.
+    """
+
+    def __init__(self, body, cache, key):
+        self._body = body
+        self._cache = cache
+        self._key = key
+        try:
+            self._tmp_path, self._copy = cache.begin_fill(key)
+        except OSError:
+            self._tmp_path, self._copy = None, None
+
+    def read(self, size=-1):
+        data = self._body.read(size if size is not None and size >= 0 else None)
+        if self._copy is not None:
+            try:
+                if data:
+                    self._copy.write(data)
+                else:
+                    self._copy.close()
+                    self._copy = None
+                    self._cache.commit(self._key, self._tmp_path)
+                    self._tmp_path = None
+            except OSError:
+                self._abandon_copy()
+        return data
+
+    def readable(self):
+        return True
+
+    def _abandon_copy(self):
+        if self._copy is not None:
+            self._copy.close()
+            self._copy = None
+        if self._tmp_path is not None:
+            self._tmp_path.unlink(missing_ok=True)
+            self._tmp_path = None
+
+    def close(self):
+        self._abandon_copy()
+        self._body.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class S3Storage:
+    """
+    S3-compatible object store (AWS S3, MinIO, ...). Objects are stored under
+    their plain key; reads and writes are streamed, and `url()` returns presigned
+    GET URLs so clients can be redirected straight to the store.
+    """
+
+    is_local = False
+
+    def __init__(self, bucket, cache, endpoint_url=None, region=None,
+                 access_key=None, secret_key=None, public_endpoint_url=None):
+        try:
+            import boto3
+            from botocore.config import Config
+        except ImportError:
+            raise RuntimeError("STORAGE_BACKEND=s3 requires the boto3 package")
+
+        def client(endpoint):
+            return boto3.client(
+                's3',
+                endpoint_url=endpoint,
+                region_name=region,
+                aws_access_key_id=access_key,
+                aws_secret_access_key=secret_key,
+                # Path-style addressing works with MinIO and other self-hosted stores
+                config=Config(signature_version='s3v4', s3={'addressing_style': 'path'}),
+            )
+
+        self.bucket = bucket
+        self.cache = cache
+        self.client = client(endpoint_url)
+        # Presigned URLs must use the hostname browsers can reach, which may differ from ours
+        self._presign_client = client(public_endpoint_url) if public_endpoint_url else self.client
+        self._missing = self.client.exceptions.ClientError
+
+    def _is_not_found(self, error):
+        return error.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound')
+
+    def exists(self, key):
+        split_key(key)
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=key)
+            return True
+        except self._missing as e:
+            if self._is_not_found(e):
+                return False
+            raise
+
+    def open(self, key):
+        """Cached copy if present, otherwise a streaming body from the store that fills the cache as it is read"""
+        split_key(key)
+        cached = self.cache.get(key)
+        if cached:
+            try:
+                return open(cached, 'rb')
+            except FileNotFoundError:
+                pass  # evicted between lookup and open
+        try:
+            body = self.client.get_object(Bucket=self.bucket, Key=key)['Body']
+        except self._missing as e:
+            if self._is_not_found(e):
+                raise FileNotFoundError(key)
+            raise
+        return _CacheFillingReader(body, self.cache, key)
+
+    def download(self, key, dest_path):
+        """
+        Copy `key` to dest_path, a file owned by the caller for as long as it needs
+        it, serving from the read-through cache when possible and filling it otherwise.
+        """
+        cached = self.cache.get(key)
+        if cached:
+            try:
+                shutil.copyfile(cached, dest_path)
+                return dest_path
+            except FileNotFoundError:
+                pass  # evicted between lookup and copy; fetch it again
+        try:
+            self.client.download_file(self.bucket, key, str(dest_path))
+        except self._missing as e:
+            if self._is_not_found(e):
+                raise FileNotFoundError(key)
+            raise
+        with open(dest_path, 'rb') as f:
+            self.cache.fill(key, f)
+        return dest_path
+
+    def save(self, key, fileobj):
+        split_key(key)
+        # upload_fileobj switches to multipart for large bodies, so memory use stays bounded
+        self.client.upload_fileobj(fileobj, self.bucket, key)
+
+    def put_file(self, key, source_path):
+        split_key(key)
+        self.client.upload_file(str(source_path), self.bucket, key)
+
+    def list(self, prefix):
+        prefix = prefix.rstrip('/') + '/'
+        keys = []
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix, Delimiter='/'):
+            keys.extend(obj['Key'] for obj in page.get('Contents', []))
+        return sorted(keys)
+
+    def url(self, key, expires=3600):
+        split_key(key)
+        return self._presign_client.generate_presigned_url(
+            'get_object', Params={'Bucket': self.bucket, 'Key': key}, ExpiresIn=expires
+        )
+
+    def cleanup(self, max_age_seconds, log=print):
+        """Delete objects older than max_age_seconds; returns (objects, bytes)"""
+        threshold = time.time() - max_age_seconds
+        deleted = 0
+        freed = 0
+        batch = []
+        paginator = self.client.get_paginator('list_objects_v2')
+        for namespace in ('uploads/', 'outputs/'):
+            for page in paginator.paginate(Bucket=self.bucket, Prefix=namespace):
+                for obj in page.get('Contents', []):
+                    if obj['LastModified'].timestamp() < threshold:
+                        batch.append({'Key': obj['Key']})
+                        freed += obj['Size']
+                    if len(batch) == 1000:  # DeleteObjects limit
+                        self.client.delete_objects(Bucket=self.bucket, Delete={'Objects': batch})
+                        deleted += len(batch)
+                        batch = []
+        if batch:
+            self.client.delete_objects(Bucket=self.bucket, Delete={'Objects': batch})
+            deleted += len(batch)
+        log(f"[CLEANUP] Deleted {deleted} objects from bucket {self.bucket}")
+        return deleted, freed
@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# The app modules live next to this folder, not in an installed package
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
@@ -0,0 +1,107 @@
+# Run from generateImg/: python -m pytest tests
+import os
+from concurrent.futures.process import BrokenProcessPool
+
+import pytest
+from PIL import Image
+
+from image_ops import ImageWorkerPool, is_readable_image, optimize_image_for_gemini
+
+
+# Task functions are looked up by name in the spawned workers, so they must live at module level
+def _file_size(image_path):
+    return os.path.getsize(image_path)
+
+
+def _kill_worker(image_path):
+    os._exit(1)
+
+
+@pytest.fixture
+def image(tmp_path):
+    path = tmp_path / "input.jpg"
+    Image.new('RGB', (64, 48), 'red').save(path)
+    return path
+
+
+@pytest.fixture
+def pool():
+    # inline_max_bytes=0 sends every task to the workers
+    pool = ImageWorkerPool(workers=1, max_pending=4, inline_max_bytes=0)
+    yield pool
+    pool.shutdown()
+
+
+def test_small_image_runs_inline(image):
+    pool = ImageWorkerPool(workers=1, max_pending=4, inline_max_bytes=1024 * 1024)
+    assert pool.run(_file_size, str(image)) == image.stat().st_size
+    stats = pool.snapshot()
+    assert stats['inline_tasks'] == 1
+    assert stats['pooled_tasks'] == 0
+
+
+def test_pooled_task_returns_result(pool, image):
+    assert pool.run(_file_size, str(image)) == image.stat().st_size
+    stats = pool.snapshot()
+    assert stats['pooled_tasks'] == 1
+    assert stats['queue_depth'] == 0
+    assert stats['running'] == 0
+
+
+def test_pool_restarts_after_worker_dies(pool, image):
+    with pytest.raises(BrokenProcessPool):
+        pool.run(_kill_worker, str(image))
+    stats = pool.snapshot()
+    assert stats['broken']
+    assert stats['failed_tasks'] == 1
+
+    assert pool.run(_file_size, str(image)) == image.stat().st_size
+    stats = pool.snapshot()
+    assert not stats['broken']
+    assert stats['restarts'] == 1
+
+
+def test_isolated_task_does_not_break_shared_pool(pool, image):
+    assert pool.run(_file_size, str(image)) == image.stat().st_size
+    with pytest.raises(BrokenProcessPool):
+        pool.run(_kill_worker, str(image), isolated=True)
+    assert pool.run(_file_size, str(image), isolated=True) == image.stat().st_size
+
+    stats = pool.snapshot()
+    assert stats['isolated_tasks'] == 2
+    assert not stats['broken']
+    assert stats['restarts'] == 0
+
+
+def test_cancel_check_stops_waiting(pool, image):
+    class Cancelled(Exception):
+        pass
+
+    def cancel_check():
+        raise Cancelled()
+
+    with pytest.raises(Cancelled):
+        pool.run(_file_size, str(image), cancel_check=cancel_check, poll_seconds=0.01)
+    assert pool.snapshot()['pooled_tasks'] == 0
+
+
+def test_optimize_downscales_large_image(tmp_path):
+    path = tmp_path / "large.jpg"
+    Image.new('RGB', (3000, 1500), 'blue').save(path)
+    assert optimize_image_for_gemini(str(path))
+    with Image.open(path) as img:
+        assert img.size == (1024, 512)
+    assert [p.name for p in tmp_path.iterdir()] == ["large.jpg"]  # no temp file left behind
+
+
+def test_unoptimizable_image_is_still_readable(tmp_path):
+    path = tmp_path / "palette.jpg"
+    Image.new('P', (32, 32)).save(path, format='PNG')
+    assert not optimize_image_for_gemini(str(path))
+    assert is_readable_image(str(path))
+
+
+def test_non_image_is_not_readable(tmp_path):
+    path = tmp_path / "notes.jpg"
+    path.write_text("not an image")
+    assert not is_readable_image(str(path))
@@ -0,0 +1,163 @@
+# Run from generateImg/: python -m pytest tests
+import io
+import os
+import time
+
+import pytest
+
+from storage import LocalShardedStorage, ReadThroughCache, S3Storage, shard_of, split_key
+
+
+@pytest.fixture
+def local(tmp_path):
+    return LocalShardedStorage(tmp_path / "storage")
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return ReadThroughCache(tmp_path / "cache", max_bytes=1024 * 1024)
+
+
+@pytest.fixture
+def s3(cache, monkeypatch):
+    moto = pytest.importorskip('moto')
+    import boto3
+
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    with moto.mock_aws():
+        boto3.client('s3', region_name='us-east-1').create_bucket(Bucket='generateimg-test')
+        yield S3Storage('generateimg-test', cache, region='us-east-1')
+
+
+@pytest.mark.parametrize('key', ['uploads', 'uploads/', '../x', 'outputs/run/../x', 'outputs/./x', 'outputs/a\\b/x'])
+def test_split_key_rejects_unsafe_keys(key):
+    with pytest.raises(ValueError):
+        split_key(key)
+
+
+def test_split_key_parts():
+    assert split_key('outputs/run1/step1/a.png') == ('outputs', 'run1', ['step1', 'a.png'])
+    assert split_key('uploads/abc_me.jpg') == ('uploads', 'abc_me.jpg', [])
+
+
+def test_local_layout_is_sharded_by_id(local):
+    path = local.local_path('outputs/run1/step1/a.png')
+    assert path == local.root.joinpath('outputs', *shard_of('run1'), 'run1', 'step1', 'a.png')
+
+
+def test_local_save_open_list_download(local, tmp_path):
+    local.save('outputs/run1/step1/a.png', io.BytesIO(b'aaa'))
+    local.save('outputs/run1/step1/b.png', io.BytesIO(b'bbb'))
+    local.save('outputs/run1/step2/c.png', io.BytesIO(b'ccc'))
+
+    assert local.exists('outputs/run1/step1/a.png')
+    assert not local.exists('outputs/run1/step1/missing.png')
+    with local.open('outputs/run1/step1/b.png') as f:
+        assert f.read() == b'bbb'
+    assert local.list('outputs/run1/step1/') == ['outputs/run1/step1/a.png', 'outputs/run1/step1/b.png']
+    assert local.list('outputs/run2/step1/') == []
+
+    dest = local.download('outputs/run1/step2/c.png', tmp_path / 'c.png')
+    assert dest.read_bytes() == b'ccc'
+    assert local.url('outputs/run1/step2/c.png') is None
+
+
+def test_local_cleanup_removes_old_runs_only(local):
+    local.save('outputs/old/step1/a.png', io.BytesIO(b'x' * 10))
+    local.save('outputs/new/step1/a.png', io.BytesIO(b'y' * 10))
+    run_folder = local.local_path('outputs/old/step1/a.png').parent.parent
+    long_ago = time.time() - 7200
+    os.utime(run_folder, (long_ago, long_ago))
+
+    assert local.cleanup(3600, log=lambda msg: None) == (1, 10)
+    assert not local.exists('outputs/old/step1/a.png')
+    assert local.exists('outputs/new/step1/a.png')
+
+
+def test_cache_evicts_least_recently_used(tmp_path):
+    cache = ReadThroughCache(tmp_path / "cache", max_bytes=250)
+    a = cache.fill('outputs/r/a.png', io.BytesIO(b'a' * 100))
+    cache.fill('outputs/r/b.png', io.BytesIO(b'b' * 100))
+    assert cache.get('outputs/r/a.png') == a  # a is now the most recently used
+    cache.fill('outputs/r/c.png', io.BytesIO(b'c' * 100))
+
+    assert cache.get('outputs/r/b.png') is None
+    assert cache.get('outputs/r/a.png') == a
+    assert cache.get('outputs/r/c.png') is not None
+    assert cache._total == 200
+    assert sum(p.stat().st_size for p in cache.root.rglob('*') if p.is_file()) == 200
+
+
+def test_cache_keeps_single_oversized_entry(tmp_path):
+    cache = ReadThroughCache(tmp_path / "cache", max_bytes=50)
+    path = cache.fill('outputs/r/big.png', io.BytesIO(b'x' * 100))
+    assert cache.get('outputs/r/big.png') == path
+
+
+def test_cache_rescans_disk_on_startup(tmp_path):
+    cache = ReadThroughCache(tmp_path / "cache", max_bytes=1000)
+    path = cache.fill('outputs/r/a.png', io.BytesIO(b'a' * 100))
+    leftover = path.with_name(f".{path.name}.123.tmp")
+    leftover.write_bytes(b'partial')
+
+    reopened = ReadThroughCache(tmp_path / "cache", max_bytes=1000)
+    assert reopened.get('outputs/r/a.png') == path
+    assert reopened._total == 100
+    assert not leftover.exists()
+
+
+def test_s3_save_exists_list(s3):
+    s3.save('outputs/run1/step1/a.png', io.BytesIO(b'aaa'))
+    s3.put_file('outputs/run1/step1/b.png', __file__)
+    s3.save('outputs/run1/step2/c.png', io.BytesIO(b'ccc'))
+
+    assert s3.exists('outputs/run1/step1/a.png')
+    assert not s3.exists('outputs/run1/step1/missing.png')
+    assert s3.list('outputs/run1/step1') == ['outputs/run1/step1/a.png', 'outputs/run1/step1/b.png']
+
+
+def test_s3_download_fills_cache(s3, tmp_path):
+    s3.save('outputs/run1/step1/a.png', io.BytesIO(b'aaa'))
+    dest = s3.download('outputs/run1/step1/a.png', tmp_path / 'a.png')
+    assert dest.read_bytes() == b'aaa'
+    assert s3.cache.get('outputs/run1/step1/a.png').read_bytes() == b'aaa'
+
+    with pytest.raises(FileNotFoundError):
+        s3.download('outputs/run1/step1/missing.png', tmp_path / 'missing.png')
+
+
+def test_s3_open_fills_cache_only_when_fully_read(s3):
+    data = os.urandom(200 * 1024)
+    s3.save('outputs/run1/step1/a.png', io.BytesIO(data))
+
+    with s3.open('outputs/run1/step1/a.png') as f:
+        f.read(1024)
+    assert s3.cache.get('outputs/run1/step1/a.png') is None
+    assert not [p for p in s3.cache.root.rglob('*') if p.is_file()]  # partial copy removed
+
+    with s3.open('outputs/run1/step1/a.png') as f:
+        assert b''.join(iter(lambda: f.read(64 * 1024), b'')) == data
+    assert s3.cache.get('outputs/run1/step1/a.png').read_bytes() == data
+
+
+def test_s3_open_missing_or_invalid_key(s3):
+    with pytest.raises(FileNotFoundError):
+        s3.open('outputs/run1/step1/missing.png')
+    with pytest.raises(ValueError):
+        s3.open('../etc/passwd')
+
+
+def test_s3_presigned_url(s3):
+    url = s3.url('outputs/run1/step1/a.png', expires=60)
+    assert '/generateimg-test/outputs/run1/step1/a.png?' in url
+    assert 'X-Amz-Expires=60' in url
+
+
+def test_s3_cleanup_deletes_old_objects(s3):
+    s3.save('uploads/abc_me.jpg', io.BytesIO(b'12345'))
+    s3.save('outputs/run1/step1/a.png', io.BytesIO(b'123'))
+
+    assert s3.cleanup(3600, log=lambda msg: None) == (0, 0)
+    assert s3.cleanup(-60, log=lambda msg: None) == (2, 8)
+    assert not s3.exists('uploads/abc_me.jpg')